@@ -1,7 +1,7 @@
+#!/usr/bin/env python3
 """
 Watcher is a daemon that monitors directories for file changes and runs jobs
 """
-#!/usr/bin/env python
 # Copyright (c) 2010 Greggory Hernandez
 
 # Permission is hereby granted, free of charge, to any person obtaining a copy
@@ -39,12 +39,72 @@ import os
 import time
 import atexit
 import argparse
-from signal import SIGTERM
-import datetime
+import errno
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import operator
+import re
+import multiprocessing
+import select
+import selectors
+import shlex
+from signal import SIG_DFL, SIGCHLD, SIGINT, SIGKILL, SIGTERM, signal
 from string import Template
+from typing import Callable, Iterable, List, NamedTuple, Optional
 import configparser
 import pyinotify
 
+# event fields that can be used as placeholders in a job's command
+FIELDS = ("watched", "filename", "tflags", "nflags", "cookie", "count")
+
+# characters that only a shell knows how to interpret
+SHELL_CHARS = frozenset("|&;<>()`*?[]~#\n")
+
+# builtins and keywords, a command starting with one of them needs a shell
+SHELL_WORDS = frozenset(
+    (
+        "!", ".", ":", "{", "}", "alias", "bg", "break", "case", "cd", "command",
+        "continue", "do", "done", "elif", "else", "esac", "eval", "exec", "exit",
+        "export", "fg", "fi", "for", "function", "getopts", "hash", "if", "jobs",
+        "local", "read", "readonly", "return", "set", "shift", "source", "then",
+        "time", "times", "trap", "type", "ulimit", "umask", "unalias", "unset",
+        "until", "wait", "while",
+    )
+)
+
+# a leading NAME=value argument sets an environment variable for the command
+ASSIGNMENT = re.compile(r"[A-Za-z_][A-Za-z0-9_]*=")
+
+# events that can be watched, by the name used in the config file
+MASKS = {
+    "access": pyinotify.IN_ACCESS,
+    "attribute_change": pyinotify.IN_ATTRIB,
+    "write_close": pyinotify.IN_CLOSE_WRITE,
+    "nowrite_close": pyinotify.IN_CLOSE_NOWRITE,
+    "create": pyinotify.IN_CREATE,
+    "delete": pyinotify.IN_DELETE,
+    "self_delete": pyinotify.IN_DELETE_SELF,
+    "modify": pyinotify.IN_MODIFY,
+    "self_move": pyinotify.IN_MOVE_SELF,
+    "move_from": pyinotify.IN_MOVED_FROM,
+    "move_to": pyinotify.IN_MOVED_TO,
+    "open": pyinotify.IN_OPEN,
+}
+MASKS["all"] = functools.reduce(operator.or_, MASKS.values())
+MASKS["move"] = pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+MASKS["close"] = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CLOSE_NOWRITE
+
+# compiled exclude patterns, shared by the jobs using the same regexp
+EXCLUDE_PATTERNS = {}
+
+# reads done on an inotify descriptor before going back to select(), so that
+# a burst on one job neither starves the other jobs nor delays batched commands
+DRAIN_ROUNDS = 4
+
+# inotify limits raised at startup so bursts of events aren't dropped
+INOTIFY_LIMITS = {"max_queued_events": 65536, "max_user_watches": 524288}
+
 class Daemon:
     """A generic daemon class"""
 
@@ -90,17 +150,37 @@ class Daemon:
         # redirect standard file descriptors
         sys.stdout.flush()
         sys.stderr.flush()
-        std_in = open(self.stdin, "r", encoding="utf-8")
-        std_out = open(self.stdout, "a+", encoding="utf-8")
-        std_err = open(self.stderr, "a+", encoding="utf-8")
-        os.dup2(std_in.fileno(), sys.stdin.fileno())
-        os.dup2(std_out.fileno(), sys.stdout.fileno())
-        os.dup2(std_err.fileno(), sys.stderr.fileno())
+        with open(self.stdin, "r", encoding="utf-8") as std_in:
+            os.dup2(std_in.fileno(), sys.stdin.fileno())
+        with open(self.stdout, "a+", encoding="utf-8") as std_out:
+            os.dup2(std_out.fileno(), sys.stdout.fileno())
+        with open(self.stderr, "a+", encoding="utf-8") as std_err:
+            os.dup2(std_err.fileno(), sys.stderr.fileno())
 
         # write pid file
         atexit.register(self.delpid)
-        pid = str(os.getpid())
-        open(self.pidfile, "w+", encoding="utf-8").write(f"{pid}\n")
+        pid_fd = os.open(
+            self.pidfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644
+        )
+        try:
+            os.write(pid_fd, f"{os.getpid()}\n".encode())
+            os.fsync(pid_fd)
+        finally:
+            os.close(pid_fd)
+
+    def _read_pid(self):
+        """
+        Read the pid from the pidfile, None if there is no pidfile
+        """
+        try:
+            pid_fd = os.open(self.pidfile, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            return None
+        try:
+            pid = os.read(pid_fd, 32).strip()
+        finally:
+            os.close(pid_fd)
+        return int(pid) if pid else None
 
     def delpid(self):
         """
@@ -113,12 +193,7 @@ class Daemon:
         Start the daemon
         """
         # Check for a pidfile to see if the daemon already runs
-        try:
-            pid_file = open(self.pidfile, "r", encoding="utf-8")
-            pid = int(pid_file.read().strip())
-            pid_file.close()
-        except IOError:
-            pid = None
+        pid = self._read_pid()
 
         if pid:
             message = "pidfile %s already exists. Daemon already running?\n"
@@ -134,31 +209,65 @@ class Daemon:
         Stop the daemon
         """
         # get the pid from the pidfile
-        try:
-            pid_file = open(self.pidfile, "r", encoding="utf-8")
-            pid = int(pid_file.read().strip())
-            pid_file.close()
-        except IOError:
-            pid = None
+        pid = self._read_pid()
 
         if not pid:
             message = "pidfile %s does not exist. Daemon not running?\n"
             sys.stderr.write(message % self.pidfile)
             return  # not an error in a restart
 
-        # Try killing the daemon process
+        # Try killing the daemon process, a stale pidfile is simply removed
         try:
-            while 1:
-                os.kill(pid, SIGTERM)
-                time.sleep(0.1)
+            os.kill(pid, SIGTERM)
         except OSError as err:
-            err = str(err)
-            if err.find("No such process") > 0:
-                if os.path.exists(self.pidfile):
-                    os.remove(self.pidfile)
-            else:
+            if err.errno != errno.ESRCH:
                 print(str(err))
                 sys.exit(1)
+        else:
+            if not self._wait_exit(pid, 10.0):
+                # the daemon didn't shut down in time
+                try:
+                    os.kill(pid, SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self._wait_exit(pid, 1.0)
+
+        if os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
+
+    def _wait_exit(self, pid, timeout):
+        """
+        Wait up to timeout seconds for a process to exit.
+        Returns False if the process is still running
+        """
+        try:
+            pidfd = os.pidfd_open(pid)  # pylint: disable=no-member
+        except ProcessLookupError:
+            return True
+        except (AttributeError, OSError):
+            # no pidfd support (Python < 3.9 or Linux < 5.3)
+            return self._poll_exit(pid, timeout)
+        try:
+            poller = select.poll()
+            poller.register(pidfd, select.POLLIN)
+            return bool(poller.poll(timeout * 1000))
+        finally:
+            os.close(pidfd)
+
+    def _poll_exit(self, pid, timeout):
+        """
+        Wait up to timeout seconds for /proc/<pid> to disappear, checking
+        less and less often. Returns False if the process is still running
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while os.path.exists(f"/proc/{pid}"):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1.0)
+        return True
 
     def restart(self):
         """
@@ -171,12 +280,7 @@ class Daemon:
         """
         Check the status of the daemon
         """
-        try:
-            pid_file = open(self.pidfile, "r", encoding="utf-8")
-            pid = int(pid_file.read().strip())
-            pid_file.close()
-        except IOError:
-            pid = None
+        pid = self._read_pid()
 
         if pid:
             print("service running")
@@ -197,12 +301,55 @@ class EventHandler(pyinotify.ProcessEvent):
     This class is used to handle events from the inotify kernel subsystem.
     It is used by the WatchManager class.
     """
+    # the batching state and the pre-split command are plain attributes as
+    # they are read for every event
+    # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, command):
+    def __init__(self, command, pool, mask, batch_window_ms=0, verbose=False):
         pyinotify.ProcessEvent.__init__(self)
         self.command = command
-
-    def shellquote(self, string):
+        self.pool = pool
+        self.mask = mask
+        self.verbose = verbose
+        self.batch_window = batch_window_ms / 1000.0
+        self._pending = {}
+        # monotonic time at which the queued events are due, None when idle
+        self.deadline = None
+        self._template = Template(command)
+
+        # Split the command once so that events can be handled without a
+        # shell, only the arguments holding placeholders are filled in for
+        # each event. Commands using shell syntax keep going through /bin/sh.
+        try:
+            tokens = shlex.split(command)
+        except ValueError:
+            tokens = []
+        # shlex takes line breaks for blanks, the shell for command separators
+        if "\n" in command or (
+            tokens and (tokens[0] in SHELL_WORDS or ASSIGNMENT.match(tokens[0]))
+        ):
+            tokens = []
+        # the arguments are kept as bytes, they go through the pool's pipe and
+        # posix_spawnp as is and only the placeholders are encoded per event
+        self._argv = [os.fsencode(token) for token in tokens] or None
+        self._slots = []
+        blank = dict.fromkeys(FIELDS, "")
+        for index, token in enumerate(tokens):
+            # $$ escapes a variable meant for the shell
+            if SHELL_CHARS.intersection(token) or "$$" in token:
+                self._argv = None
+                break
+            if "$" in token:
+                template = Template(token)
+                try:
+                    template.substitute(blank)
+                except (KeyError, ValueError):
+                    # let the shell path handle the invalid placeholder
+                    self._argv = None
+                    break
+                self._slots.append((index, template))
+
+    def shellquote(self, string: object) -> str:
         """
         Prepares a string for use as a shell command.
         """
@@ -210,223 +357,335 @@ class EventHandler(pyinotify.ProcessEvent):
         string = str(string)
         return "'" + string.replace("'", "'\\''") + "'"
 
-    def run_command(self, event):
-        """
-        Runs the command specified in the constructor.
-        """
-        template = Template(self.command)
-        command = template.substitute(
-            watched=self.shellquote(event.path),
-            filename=self.shellquote(event.pathname),
-            tflags=self.shellquote(event.maskname),
-            nflags=self.shellquote(event.mask),
-            cookie=self.shellquote(event.cookie if hasattr(event, "cookie") else 0),
-        )
-        try:
-            os.system(command)
-        except OSError as err:
-            print(f"Failed to run command '{command}' {err}")
-
-    def process_in_access(self, event):
-        """
-        This method is called on an access event.
-        """
-        print("Access: ", event.pathname)
-        self.run_command(event)
-
-    def process_in_attrib(self, event):
-        """
-        This method is called on an attrib event.
-        """
-        print("Attrib: ", event.pathname)
-        self.run_command(event)
-
-    def process_in_close_write(self, event):
+    def process_default(self, event):
         """
-        This method is called on a close write event.
+        Queues the event. Events on the same path with the same mask arriving
+        within the batch window only run the command once.
         """
-        print("Close write: ", event.pathname)
-        self.run_command(event)
+        # skip the events the job didn't ask for: IN_IGNORED when a watch goes
+        # away, IN_CREATE added to the watches by auto_add, ...
+        if not event.mask & self.mask:
+            return
+        if self.verbose:
+            log(f"{event.maskname}: {event.pathname}")
+        if not self.batch_window:
+            self.run_command(event)
+            return
 
-    def process_in_close_nowrite(self, event):
-        """
-        This method is called on a close nowrite event.
-        """
-        print("Close nowrite: ", event.pathname)
-        self.run_command(event)
+        key = (event.pathname, event.mask)
+        _, count = self._pending.get(key, (None, 0))
+        self._pending[key] = (event, count + 1)
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.batch_window
 
-    def process_in_create(self, event):
-        """ "
-        This method is called on a create event.
+    def flush(self):
         """
-        print("Creating: ", event.pathname)
-        self.run_command(event)
-
-    def process_in_delete(self, event):
+        Runs the command once for each batch of queued events.
         """
-        This method is called on a delete event.
-        """
-        print("Deleteing: ", event.pathname)
-        self.run_command(event)
+        pending = self._pending
+        self._pending = {}
+        self.deadline = None
+        for event, count in pending.values():
+            self.run_command(event, count)
 
-    def process_in_modify(self, event):
+    def run_command(self, event: pyinotify.Event, count: int = 1) -> None:
         """
-        This method is called on a modify event.
+        Runs the command specified in the constructor.
         """
-        print("Modify: ", event.pathname)
-        self.run_command(event)
+        values = {
+            "watched": event.path,
+            "filename": event.pathname,
+            "tflags": event.maskname,
+            "nflags": event.mask,
+            "cookie": getattr(event, "cookie", 0),
+            "count": count,
+        }
+        try:
+            if self._argv is None:
+                command = self._template.substitute(
+                    {name: self.shellquote(value) for name, value in values.items()}
+                )
+                argv = [b"/bin/sh", b"-c", os.fsencode(command)]
+            else:
+                argv = list(self._argv)
+                for index, template in self._slots:
+                    argv[index] = os.fsencode(template.substitute(values))
+        except (KeyError, ValueError) as err:
+            # commands are checked when the job is parsed, this only protects
+            # the other jobs sharing the event loop
+            log(f"Invalid placeholder in command '{self.command}' {err}")
+            return
+        self.pool.apply_async(spawn, (argv,), error_callback=self._command_failed)
 
-    def process_in_move_self(self, event):
-        """
-        This method is called on a move self event.
-        """
-        print("Move self: ", event.pathname)
-        self.run_command(event)
+    def _command_failed(self, err):
+        print(f"Failed to run command '{self.command}' {err}")
 
-    def process_in_moved_from(self, event):
-        """
-        This method is called on a moved from event.
-        """
-        print("Moved from: ", event.pathname)
-        self.run_command(event)
 
-    def process_in_moved_to(self, event):
-        """
-        This method is called on a moved to event.
-        """
-        print("Moved to: ", event.pathname)
-        self.run_command(event)
+class Job(NamedTuple):
+    """
+    A job, as read from a section of the config file.
+    """
 
-    def process_in_open(self, event):
-        """
-        This method is called on an open event.
-        """
-        print("Opened: ", event.pathname)
-        self.run_command(event)
+    name: str
+    watch: str
+    mask: int
+    recursive: bool
+    autoadd: bool
+    exclude_filter: Optional[Callable[[str], bool]]
+    command: str
+    batch_window_ms: int
 
 
 class WatcherDaemon(Daemon):
     """
     This class is used to daemonize the watcher.
     """
-    # pylint: disable=redefined-outer-name, super-init-not-called
-    def __init__(self, config):
+    # pylint: disable=redefined-outer-name, super-init-not-called, too-many-instance-attributes
+    def __init__(self, config, verbose=False):
         self.stdin = "/dev/null"
         self.stdout = config.get("DEFAULT", "logfile")
         self.stderr = config.get("DEFAULT", "logfile")
         self.pidfile = config.get("DEFAULT", "pidfile")
         self.config = config
+        self.pool = None
+        self.verbose = verbose
+        # jobs are only parsed when starting, so that stop and status keep
+        # working with a config file having a broken job
+        self.jobs = None
+
+    def start(self):
+        # report broken jobs on the terminal, before going to the background
+        self.jobs = self._load_jobs()
+        Daemon.start(self)
 
     def run(self):
+        if self.jobs is None:
+            self.jobs = self._load_jobs()
         log("Daemon started")
-        wdds = []
-        notifiers = []
+        signal(SIGTERM, terminate)
+        self._raise_inotify_limits()
 
-        # read jobs from config file
-        for section in self.config.sections():
-            log(section + ": " + self.config.get(section, "watch"))
-            # get the basic config info
-            mask = self._parse_mask(self.config.get(section, "events").split(","))
-            folder = self.config.get(section, "watch")
-            recursive = self.config.getboolean(section, "recursive")
-            autoadd = self.config.getboolean(section, "autoadd")
-            excluded = self.config.get(section, "excluded")
-            command = self.config.get(section, "command")
-
-            # Exclude directories right away if 'excluded' regexp is set
-            # Example https://github.com/seb-m/pyinotify/blob/master/python2/examples/exclude.py
-            if excluded.strip() == "":  # if 'excluded' is empty or whitespaces only
-                excl = None
-            else:
-                excl = pyinotify.ExcludeFilter(excluded.split(","))
+        # commands run in a pool of workers forked before any watch is set up,
+        # so the daemon itself never forks on an event
+        self.pool = multiprocessing.Pool(  # pylint: disable=consider-using-with
+            processes=max(4, os.cpu_count() or 1), initializer=init_worker
+        )
+        atexit.register(self._close_pool)
+        wdds = []
+        handlers = []
+        selector = selectors.DefaultSelector()
 
+        for job in self.jobs:
+            log(job.name + ": " + job.watch)
             watch_manager = pyinotify.WatchManager()
-            handler = EventHandler(command)
+            handler = EventHandler(
+                job.command, self.pool, job.mask, job.batch_window_ms, self.verbose
+            )
+            handlers.append(handler)
+
+            # pyinotify would walk the tree one directory at a time
+            paths = job.watch
+            if job.recursive and os.path.isdir(job.watch) and not os.path.islink(job.watch):
+                paths = list_dirs(job.watch)
 
             wdds.append(
                 watch_manager.add_watch(
-                    folder, mask, rec=recursive, auto_add=autoadd, exclude_filter=excl
+                    paths,
+                    job.mask,
+                    rec=False,
+                    auto_add=job.autoadd,
+                    exclude_filter=job.exclude_filter,
                 )
             )
 
-            # BUT we need a new ThreadNotifier so I can specify a different
-            # EventHandler instance for each job
-            # this means that each job has its own thread as well (I think)
-            notifiers.append(pyinotify.ThreadedNotifier(watch_manager, handler))
-
-        # now we need to start ALL the notifiers.
-        for notifier in notifiers:
-            notifier.start()
-
-    def _parse_mask(self, masks):
-        ret = False
-
-        for mask in masks:
-            mask = mask.strip()
-
-            if "access" == mask:
-                ret = self._add_mask(pyinotify.IN_ACCESS, ret)
-            elif "attribute_change" == mask:
-                ret = self._add_mask(pyinotify.IN_ATTRIB, ret)
-            elif "write_close" == mask:
-                ret = self._add_mask(pyinotify.IN_CLOSE_WRITE, ret)
-            elif "nowrite_close" == mask:
-                ret = self._add_mask(pyinotify.IN_CLOSE_NOWRITE, ret)
-            elif "create" == mask:
-                ret = self._add_mask(pyinotify.IN_CREATE, ret)
-            elif "delete" == mask:
-                ret = self._add_mask(pyinotify.IN_DELETE, ret)
-            elif "self_delete" == mask:
-                ret = self._add_mask(pyinotify.IN_DELETE_SELF, ret)
-            elif "modify" == mask:
-                ret = self._add_mask(pyinotify.IN_MODIFY, ret)
-            elif "self_move" == mask:
-                ret = self._add_mask(pyinotify.IN_MOVE_SELF, ret)
-            elif "move_from" == mask:
-                ret = self._add_mask(pyinotify.IN_MOVED_FROM, ret)
-            elif "move_to" == mask:
-                ret = self._add_mask(pyinotify.IN_MOVED_TO, ret)
-            elif "open" == mask:
-                ret = self._add_mask(pyinotify.IN_OPEN, ret)
-            elif "all" == mask:
-                all_mask = (
-                    pyinotify.IN_ACCESS
-                    | pyinotify.IN_ATTRIB
-                    | pyinotify.IN_CLOSE_WRITE
-                    | pyinotify.IN_CLOSE_NOWRITE
-                    | pyinotify.IN_CREATE
-                    | pyinotify.IN_DELETE
-                    | pyinotify.IN_DELETE_SELF
-                    | pyinotify.IN_MODIFY
-                    | pyinotify.IN_MOVE_SELF
-                    | pyinotify.IN_MOVED_FROM
-                    | pyinotify.IN_MOVED_TO
-                    | pyinotify.IN_OPEN
-                )
-                ret = self._add_mask(all_mask, ret)
-            elif "move" == mask:
-                ret = self._add_mask(
-                    pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO, ret
-                )
-            elif "close" == mask:
-                ret = self._add_mask(
-                    pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CLOSE_NOWRITE, ret
-                )
+            # each job gets its own Notifier so events reach the right
+            # EventHandler, but they are all driven from the loop below
+            notifier = pyinotify.Notifier(watch_manager, handler)
+            selector.register(watch_manager.get_fd(), selectors.EVENT_READ, notifier)
+
+        # a single thread waits on the inotify descriptors of all the jobs and
+        # wakes up in time to run the commands of batched events
+        while True:
+            deadlines = [h.deadline for h in handlers if h.deadline is not None]
+            timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+            for key, _ in selector.select(timeout):
+                notifier = key.data
+                # the selector is level-triggered, whatever is left after a
+                # few rounds is picked up on the next select()
+                for _ in range(DRAIN_ROUNDS):
+                    notifier.read_events()
+                    notifier.process_events()
+                    self._flush_due(handlers)
+                    if not notifier.check_events(timeout=0):
+                        break
+            self._flush_due(handlers)
+
+    def _flush_due(self, handlers):
+        now = time.monotonic()
+        for handler in handlers:
+            if handler.deadline is not None and handler.deadline <= now:
+                handler.flush()
+
+    def _close_pool(self):
+        # let the commands already queued finish
+        self.pool.close()
+        self.pool.join()
+
+    def _raise_inotify_limits(self):
+        # writing to /proc/sys/fs/inotify requires root privileges
+        for name, value in INOTIFY_LIMITS.items():
+            limit = getattr(pyinotify, name)
+            try:
+                # only write when needed, a write fails without root privileges
+                if limit.value < value:  # pylint: disable=consider-using-max-builtin
+                    limit.value = value
+            except OSError as err:
+                log(f"Unable to raise inotify {name} to {value}: {err}")
+
+    def _load_jobs(self):
+        jobs = []
+        # read jobs from config file
+        for section in self.config.sections():
+            try:
+                jobs.append(self._parse_job(self.config, section))
+            except (configparser.Error, ValueError, re.error) as err:
+                sys.stderr.write(f"Skipping job {section}: {err}\n")
+        return jobs
+
+    def _parse_job(self, config, section):
+        # Exclude directories right away if 'excluded' regexp is set
+        # Example https://github.com/seb-m/pyinotify/blob/master/python2/examples/exclude.py
+        excluded = config.get(section, "excluded")
+        if excluded.strip() == "":  # if 'excluded' is empty or whitespaces only
+            excl = None
+        else:
+            excl = exclude_filter(excluded.split(","))
 
-        return ret
+        command = config.get(section, "command")
+        try:
+            Template(command).substitute(dict.fromkeys(FIELDS, ""))
+        except KeyError as err:
+            raise ValueError(
+                f"unknown placeholder ${err.args[0]} in command, "
+                "shell variables must be written as $$VAR"
+            ) from err
+        except ValueError as err:
+            raise ValueError(f"{err} in command, a literal $ must be written as $$") from err
+
+        return Job(
+            name=section,
+            watch=config.get(section, "watch"),
+            mask=self._parse_mask(config.get(section, "events").split(",")),
+            recursive=config.getboolean(section, "recursive"),
+            autoadd=config.getboolean(section, "autoadd"),
+            exclude_filter=excl,
+            command=command,
+            batch_window_ms=config.getint(section, "batch_window_ms", fallback=50),
+        )
 
-    def _add_mask(self, new_option, current_options):
-        if not current_options:
-            return new_option
-        else:
-            return current_options | new_option
+    def _parse_mask(self, masks: Iterable[str]) -> int:
+        return functools.reduce(
+            operator.or_, (MASKS[mask.strip()] for mask in masks if mask.strip() in MASKS), 0
+        )
+
+
+def compile_pattern(pattern):
+    """
+    Compile a regexp, once for all the jobs using it
+    """
+    regex = EXCLUDE_PATTERNS.get(pattern)
+    if regex is None:
+        regex = EXCLUDE_PATTERNS[pattern] = re.compile(pattern)
+    return regex
+
+
+def exclude_filter(patterns):
+    """
+    Build a pyinotify exclude filter, a path is excluded if any regexp matches it
+    """
+    regexes = [compile_pattern(pattern) for pattern in patterns]
+
+    def excluded(path):
+        return any(regex.match(path) for regex in regexes)
+
+    return excluded
+
+
+def spawn(argv: List[bytes]) -> int:
+    """
+    Run a command in a command pool worker and wait for it to finish
+    """
+    # posix_spawn doesn't copy the page tables of the worker like fork() does.
+    # The workers hold no descriptors besides the standard ones and the
+    # pool's own pipes, which are close-on-exec.
+    pid = os.posix_spawnp(argv[0], argv, os.environ)
+    return os.waitpid(pid, 0)[1]
+
+
+def list_dirs(top, workers=8):
+    """
+    List top and all the directories below it, scanning them in parallel.
+    Like os.walk(), symlinks to directories are not followed
+    """
+
+    def scan(path):
+        try:
+            with os.scandir(path) as entries:
+                return [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return []
+
+    dirs = [top]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque([executor.submit(scan, top)])
+        while pending:
+            for path in pending.popleft().result():
+                dirs.append(path)
+                pending.append(executor.submit(scan, path))
+    return dirs
+
+
+def init_worker():
+    """
+    Set up the signal handlers of the command pool workers
+    """
+    signal(SIGCHLD, SIG_DFL)
+    # workers are shut down by the daemon through the pool, dying on a SIGTERM
+    # or a Ctrl-C sent to the whole process group could leave the pool's locks held
+    signal(SIGTERM, ignore_signal)
+    signal(SIGINT, ignore_signal)
+
+
+def ignore_signal(_signum, _frame):
+    """
+    Signal handler doing nothing. Unlike SIG_IGN it isn't inherited by commands
+    """
+
+
+def terminate(_signum, _frame):
+    """
+    Exit on SIGTERM through sys.exit so that the atexit handlers run
+    """
+    # don't interrupt the atexit handlers on a repeated SIGTERM
+    signal(SIGTERM, ignore_signal)
+    sys.exit(0)
+
+
+# the timestamp is only formatted again when the second changes
+_LOG_SECOND = None
+_LOG_STAMP = ""
 
 
 def log(msg):
     """
     Log a message to stdout
     """
-    sys.stdout.write(f"{datetime.datetime.now()} {msg}\n")
+    global _LOG_SECOND, _LOG_STAMP  # pylint: disable=global-statement
+    second = int(time.time())
+    if second != _LOG_SECOND:
+        _LOG_SECOND = second
+        _LOG_STAMP = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+    sys.stdout.write(f"{_LOG_STAMP} {msg}\n")
 
 
 
@@ -441,6 +700,12 @@ if __name__ == "__main__":
         action="store",
         help="Path to the config file (default: %(default)s)",
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Log every event received",
+    )
     parser.add_argument(
         "command",
         action="store",
@@ -461,7 +726,7 @@ if __name__ == "__main__":
         sys.exit(4)
 
     # Initialize the daemon
-    daemon = WatcherDaemon(config)
+    daemon = WatcherDaemon(config, args.verbose)
 
     # Execute the command
     if "start" == args.command: